@@ -1,47 +1,73 @@
+import fcntl
+import hashlib
+import json
 import os
-import inspect
+import sys
+import tempfile
+import threading
+import types
+from contextlib import contextmanager, suppress
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
 from google.auth import credentials
 from google.auth.exceptions import RefreshError
-from google.cloud import bigquery
-from google.cloud.exceptions import Forbidden
-from google.cloud.bigquery._http import Connection
 from kaggle_secrets import GcpTarget, UserSecretsClient
 
 from log import Log
 
+# Environment read once by _refresh_env() instead of on every client construction.
+_ENV = {}
+
+_TARGETS_BY_NAME = {target.name: target for target in GcpTarget}
+_TARGET_BITS = {target: 1 << i for i, target in enumerate(GcpTarget)}
+_BIGQUERY_BIT = _TARGET_BITS[GcpTarget.BIGQUERY]
+_GCS_BIT = _TARGET_BITS[GcpTarget.GCS]
+_AUTOML_BIT = _TARGET_BITS[GcpTarget.AUTOML]
+
 
 def get_integrations():
-    kernel_integrations_var = os.getenv("KAGGLE_KERNEL_INTEGRATIONS")
-    kernel_integrations = KernelIntegrations()
+    # Each caller gets its own KernelIntegrations so that mutating it can't corrupt the cached value.
+    return KernelIntegrations._from_bits(_parse_integrations(os.getenv("KAGGLE_KERNEL_INTEGRATIONS")))
+
+# Keyed on the raw env var value so the parsing is only redone when the env changes.
+@lru_cache(maxsize=1)
+def _parse_integrations(kernel_integrations_var):
     if kernel_integrations_var is None:
-        return kernel_integrations
+        return 0
+    bits = 0
     for integration in kernel_integrations_var.split(':'):
-        try:
-            target = GcpTarget[integration.upper()]
-            kernel_integrations.add_integration(target)
-        except KeyError as e:
-            Log.error(f"Unknown integration target: {e}")
-    return kernel_integrations
+        target = _TARGETS_BY_NAME.get(integration.upper())
+        if target is None:
+            Log.error(f"Unknown integration target: {integration!r}")
+        else:
+            bits |= _TARGET_BITS[target]
+    return bits
 
 
 class KernelIntegrations():
     def __init__(self):
-        self.integrations = {}
+        self._bits = 0
+
+    @classmethod
+    def _from_bits(cls, bits):
+        kernel_integrations = cls()
+        kernel_integrations._bits = bits
+        return kernel_integrations
 
     def add_integration(self, target):
-        self.integrations[target] = True
+        self._bits |= _TARGET_BITS[target]
 
     def has_integration(self, target):
-        return target in self.integrations
+        return bool(self._bits & _TARGET_BITS[target])
 
     def has_bigquery(self):
-        return GcpTarget.BIGQUERY in self.integrations
+        return bool(self._bits & _BIGQUERY_BIT)
 
     def has_gcs(self):
-        return GcpTarget.GCS in self.integrations
+        return bool(self._bits & _GCS_BIT)
 
     def has_automl(self):
-        return GcpTarget.AUTOML in self.integrations
+        return bool(self._bits & _AUTOML_BIT)
 
 
 class KaggleKernelCredentials(credentials.Credentials):
@@ -50,82 +76,334 @@ class KaggleKernelCredentials(credentials.Credentials):
     client = bigquery.Client(project='ANOTHER_PROJECT',
                                 credentials=KaggleKernelCredentials())
     """
+
+    # Tokens this close to expiring are refreshed in the background, without blocking requests...
+    _ASYNC_REFRESH_WINDOW = timedelta(seconds=600)
+    # ...and once they get this close, the request blocks until a new token is fetched.
+    _SYNC_REFRESH_WINDOW = timedelta(seconds=300)
+
+    # Fetched tokens are persisted here so that other processes of the same session can reuse them.
+    _TOKEN_CACHE_DIR = '/tmp'
+
+    # A single UserSecretsClient is created lazily and shared by all the credentials,
+    # it is rebuilt when the environment it was created from changes.
+    _client_cls = UserSecretsClient
+    _shared_client = None
+    _shared_client_env = None
+
+    # Fallback for UserSecretsClient versions without _get_access_token.
+    _TOKEN_METHODS = {
+        GcpTarget.BIGQUERY: 'get_bigquery_access_token',
+        GcpTarget.GCS: '_get_gcs_access_token',
+        GcpTarget.AUTOML: '_get_automl_access_token',
+    }
+
     def __init__(self, target=GcpTarget.BIGQUERY):
         super().__init__()
         self.target = target
+        self._lock = threading.Lock()
+        self._async_refresh_in_flight = False
+        # Set when a background refresh fails, background retries then wait for the synchronous window.
+        self._async_refresh_failed = False
+
+    def before_request(self, request, method, url, headers):
+        if self._expires_within(self._SYNC_REFRESH_WINDOW):
+            self._refresh_if_expiring(self._SYNC_REFRESH_WINDOW)
+        elif self._expires_within(self._ASYNC_REFRESH_WINDOW):
+            self._maybe_async_refresh()
+        self.apply(headers)
 
     def refresh(self, request):
+        # An explicit refresh (e.g. google-auth retrying a 401) always fetches a new token,
+        # unless another thread already replaced the one seen here while waiting on the lock.
+        stale_token = self.token
+        with self._lock:
+            if self.token != stale_token:
+                return
+            if stale_token:
+                self._discard_cached_token(stale_token)
+            self._refresh_token()
+
+    def _expires_within(self, window):
+        if not self.token:
+            return True
+        if not self.expiry:
+            return False
+        return self.expiry - datetime.utcnow() < window
+
+    def _refresh_if_expiring(self, window, quiet=False):
+        # Only one thread performs the round-trip, the others pick up the token it stored.
+        with self._lock:
+            if not self._expires_within(window):
+                return
+            if self._load_cached_token(window):
+                return
+            self._refresh_token(quiet)
+
+    def _token_cache_path(self):
+        return os.path.join(self._TOKEN_CACHE_DIR, f".kaggle_gcp_token_{self.target.name}.json")
+
+    @classmethod
+    def _user_secrets_client(cls):
+        client_env = (os.getenv("KAGGLE_USER_SECRETS_TOKEN"), os.getenv("KAGGLE_URL_BASE"))
+        if cls._shared_client is None or cls._shared_client_env != client_env:
+            cls._shared_client = cls._client_cls()
+            cls._shared_client_env = client_env
+        return cls._shared_client
+
+    @staticmethod
+    def _session_id(jwt_token):
+        # Tokens are only shared between processes started with the same user secrets token.
+        return hashlib.sha256(jwt_token.encode()).hexdigest() if jwt_token else None
+
+    def _load_cached_token(self, window):
+        session_id = self._session_id(os.getenv("KAGGLE_USER_SECRETS_TOKEN"))
+        if session_id is None:
+            return False
+        try:
+            with open(self._token_cache_path()) as f:
+                cached = json.load(f)
+            if cached['session'] != session_id:
+                return False
+            token, expiry = cached['token'], datetime.utcfromtimestamp(cached['expiry'])
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            Log.warning(f"Unable to read the cached access token: {e}")
+            return False
+        if expiry - datetime.utcnow() < window:
+            return False
+        self.token, self.expiry = token, expiry
+        return True
+
+    def _store_cached_token(self, session_id):
+        # Tokens without an expiry are never persisted since there is no telling when they become stale.
+        if session_id is None or not isinstance(self.expiry, datetime):
+            return
+        path = self._token_cache_path()
+        tmp_path = None
+        # The token was fetched fine, failing to cache it must not turn into a refresh error.
+        try:
+            cached = {
+                'session': session_id,
+                'token': self.token,
+                'expiry': (self.expiry - datetime(1970, 1, 1)).total_seconds(),
+            }
+            with self._token_cache_lock():
+                with tempfile.NamedTemporaryFile('w', dir=self._TOKEN_CACHE_DIR, delete=False) as f:
+                    tmp_path = f.name
+                    json.dump(cached, f)
+                os.chmod(tmp_path, 0o600)
+                os.replace(tmp_path, path)
+                tmp_path = None
+        except Exception as e:
+            Log.warning(f"Unable to cache the access token: {e}")
+        finally:
+            # Never leave a stray copy of the token behind.
+            if tmp_path is not None:
+                with suppress(OSError):
+                    os.remove(tmp_path)
+
+    def _discard_cached_token(self, token):
+        """Removes the cached token if it is the given one, so no process picks it up again."""
+        path = self._token_cache_path()
+        try:
+            with self._token_cache_lock():
+                with open(path) as f:
+                    cached = json.load(f)
+                if cached.get('token') == token:
+                    os.remove(path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            Log.warning(f"Unable to discard the cached access token: {e}")
+
+    @contextmanager
+    def _token_cache_lock(self):
+        # Serialize writers across processes, readers only ever see a complete file thanks to os.replace.
+        lock_fd = os.open(self._token_cache_path() + '.lock', os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(lock_fd)
+
+    def _maybe_async_refresh(self):
+        # Don't wait on a refresh that is already running, the current token is still usable.
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self._async_refresh_in_flight or self._async_refresh_failed:
+                return
+            self._async_refresh_in_flight = True
+        finally:
+            self._lock.release()
+        threading.Thread(target=self._async_refresh, daemon=True).start()
+
+    def _async_refresh(self):
         try:
-            client = UserSecretsClient()
-            if self.target == GcpTarget.BIGQUERY:
-                self.token, self.expiry = client.get_bigquery_access_token()
-            elif self.target == GcpTarget.GCS:
-                self.token, self.expiry = client._get_gcs_access_token()
-            elif self.target == GcpTarget.AUTOML:
-                self.token, self.expiry = client._get_automl_access_token()
+            self._refresh_if_expiring(self._ASYNC_REFRESH_WINDOW, quiet=True)
+        except RefreshError:
+            # Already logged, the synchronous refresh will surface the error if it persists.
+            self._async_refresh_failed = True
+        finally:
+            self._async_refresh_in_flight = False
+
+    def _refresh_token(self, quiet=False):
+        """Fetches a new token, quiet skips the messages meant for the user."""
+        try:
+            client = self._user_secrets_client()
+            get_access_token = getattr(client, '_get_access_token', None)
+            if get_access_token is not None:
+                self.token, self.expiry = get_access_token(self.target)
+            else:
+                # Older versions of kaggle_secrets only expose one method per target.
+                self.token, self.expiry = getattr(client, self._TOKEN_METHODS[self.target])()
+            # Keyed on the token the client authenticated with, which is what the fetched token belongs to.
+            self._store_cached_token(self._session_id(getattr(client, 'jwt_token', None)))
+            self._async_refresh_failed = False
         except ConnectionError as e:
             Log.error(f"Connection error trying to refresh access token: {e}")
-            print("There was a connection error trying to fetch the access token. "
-                  f"Please ensure internet is on in order to use the {self.target.service} Integration.")
+            if not quiet:
+                print("There was a connection error trying to fetch the access token. "
+                      f"Please ensure internet is on in order to use the {self.target.service} Integration.")
             raise RefreshError('Unable to refresh access token due to connection error.') from e
         except Exception as e:
             Log.error(f"Error trying to refresh access token: {e}")
             if (not get_integrations().has_integration(self.target)):
                 Log.error(f"No {self.target.service} integration found.")
-                print(
-                   f"Please ensure you have selected a {self.target.service} account in the Kernels Settings sidebar.")
+                if not quiet:
+                    print(
+                       f"Please ensure you have selected a {self.target.service} account in the Kernels Settings sidebar.")
             raise RefreshError('Unable to refresh access token.') from e
 
 
-class _DataProxyConnection(Connection):
-    """Custom Connection class used to proxy the BigQuery client to Kaggle's data proxy."""
-
-    API_BASE_URL = os.getenv("KAGGLE_DATA_PROXY_URL")
-
-    def __init__(self, client):
-        super().__init__(client)
-        self.extra_headers["X-KAGGLE-PROXY-DATA"] = os.getenv(
-            "KAGGLE_DATA_PROXY_TOKEN")
+class _NoRefreshAnonymous(credentials.AnonymousCredentials):
+    """Anonymous credentials which never fail to refresh, the data proxy authenticates requests itself."""
 
-    def api_request(self, *args, **kwargs):
-        """Wrap Connection.api_request in order to handle errors gracefully.
+    def refresh(self, request):
+        pass
+
+# AnonymousCredentials hold no state, so a single instance is shared by all the clients.
+_ANON = _NoRefreshAnonymous()
+
+# Shared by all the PublicBigqueryClient instances so their connections get reused.
+@lru_cache(maxsize=None)
+def _data_proxy_session():
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    class _SharedSession(AuthorizedSession):
+        def close(self):
+            # Client.close() closes its _http, which must not tear down the pool of the other clients.
+            # The pooled connections are released when the process exits.
+            pass
+
+    session = _SharedSession(_ANON)
+    # The BigQuery retry predicate only retries API errors, not dropped connections. Without a
+    # status_forcelist this Retry only covers connection failures, so it does not stack with it.
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                          max_retries=Retry(total=3, backoff_factor=0.2))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# The BigQuery library is heavy to import, so the classes extending it are only
+# defined the first time they are needed.
+@lru_cache(maxsize=None)
+def _bigquery_classes():
+    from google.cloud import bigquery
+    from google.cloud.bigquery._http import Connection
+    from google.cloud.exceptions import Forbidden
+
+    class _DataProxyConnection(Connection):
+        """Custom Connection class used to proxy the BigQuery client to Kaggle's data proxy."""
+
+        API_BASE_URL = _ENV['proxy_url']
+
+        def __init__(self, client):
+            super().__init__(client)
+            self.extra_headers["X-KAGGLE-PROXY-DATA"] = _ENV['proxy_token']
+
+        def api_request(self, *args, **kwargs):
+            """Wrap Connection.api_request in order to handle errors gracefully.
+            """
+            try:
+                return super().api_request(*args, **kwargs)
+            except Forbidden as e:
+                msg = ("Permission denied using Kaggle's public BigQuery integration. "
+                       "Did you mean to select a BigQuery account in the Kernels Settings sidebar?")
+                print(msg)
+                raise e
+
+    class PublicBigqueryClient(bigquery.client.Client):
+        """A modified BigQuery client that routes requests using Kaggle's Data Proxy to provide free access to Public Datasets.
+        Example usage:
+        from kaggle import PublicBigqueryClient
+        client = PublicBigqueryClient()
         """
-        try:
-            return super().api_request(*args, **kwargs)
-        except Forbidden as e:
-            msg = ("Permission denied using Kaggle's public BigQuery integration. "
-                   "Did you mean to select a BigQuery account in the Kernels Settings sidebar?")
-            print(msg)
-            Log.info(msg)
-            raise e
-
 
-class PublicBigqueryClient(bigquery.client.Client):
-    """A modified BigQuery client that routes requests using Kaggle's Data Proxy to provide free access to Public Datasets.
-    Example usage:
-    from kaggle import PublicBigqueryClient
-    client = PublicBigqueryClient()
+        def __init__(self, *args, **kwargs):
+            kwargs.setdefault('_http', _data_proxy_session())
+            super().__init__(
+                project=_ENV['proxy_project'], credentials=_ANON, *args, **kwargs
+            )
+            # TODO: Remove this once https://github.com/googleapis/google-cloud-python/issues/7122 is implemented.
+            self._connection = _DataProxyConnection(self)
+
+    return {
+        '_DataProxyConnection': _DataProxyConnection,
+        'PublicBigqueryClient': PublicBigqueryClient,
+    }
+
+_BIGQUERY_CLASS_NAMES = ('_DataProxyConnection', 'PublicBigqueryClient')
+
+def __getattr__(name):
+    if name in _BIGQUERY_CLASS_NAMES:
+        bigquery_class = _bigquery_classes()[name]
+        # Later lookups find the class directly, without going through here again.
+        globals()[name] = bigquery_class
+        # The factory may have been the first to import bigquery. The import hook ignores
+        # imports made from kaggle_gcp, so make sure the client gets patched.
+        if not has_been_monkeypatched(sys.modules['google.cloud.bigquery'].Client):
+            init_bigquery()
+        return bigquery_class
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Module level __getattr__ (PEP 562) is only honored starting with python 3.7.
+if sys.version_info < (3, 7):
+    class _LazyModule(types.ModuleType):
+        def __getattr__(self, name):
+            return __getattr__(name)
+
+    sys.modules[__name__].__class__ = _LazyModule
+
+def _refresh_env():
+    """Re-reads the Kaggle settings from the environment.
+
+    GOOGLE_CLOUD_PROJECT is deliberately not part of the snapshot: users commonly set it
+    from their notebook after the import, so it is read each time a client is created.
     """
-
-    def __init__(self, *args, **kwargs):
-        data_proxy_project = os.getenv("KAGGLE_DATA_PROXY_PROJECT")
-        anon_credentials = credentials.AnonymousCredentials()
-        anon_credentials.refresh = lambda *args: None
-        super().__init__(
-            project=data_proxy_project, credentials=anon_credentials, *args, **kwargs
-        )
-        # TODO: Remove this once https://github.com/googleapis/google-cloud-python/issues/7122 is implemented.
-        self._connection = _DataProxyConnection(self)
+    _ENV.update(
+        proxy_token=os.getenv("KAGGLE_DATA_PROXY_TOKEN"),
+        proxy_url=os.getenv("KAGGLE_DATA_PROXY_URL"),
+        proxy_project=os.getenv("KAGGLE_DATA_PROXY_PROJECT"),
+        user_secrets_token=os.getenv("KAGGLE_USER_SECRETS_TOKEN"),
+    )
+    if _bigquery_classes.cache_info().currsize:
+        _bigquery_classes()['_DataProxyConnection'].API_BASE_URL = _ENV['proxy_url']
 
 def has_been_monkeypatched(method):
-    return "kaggle_gcp" in inspect.getsourcefile(method)
+    return getattr(method, '_kaggle_patched', False)
 
 def init_bigquery():
     from google.auth import environment_vars
     from google.cloud import bigquery
 
-    is_proxy_token_set = "KAGGLE_DATA_PROXY_TOKEN" in os.environ
-    is_user_secrets_token_set = "KAGGLE_USER_SECRETS_TOKEN" in os.environ
+    _refresh_env()
+    is_proxy_token_set = _ENV['proxy_token'] is not None
+    is_user_secrets_token_set = _ENV['user_secrets_token'] is not None
     if not (is_proxy_token_set or is_user_secrets_token_set):
         return bigquery
 
@@ -135,59 +413,54 @@ def init_bigquery():
         from google.cloud.bigquery import magics
         magics.context.credentials = KaggleKernelCredentials()
 
+    PublicBigqueryClient = _bigquery_classes()['PublicBigqueryClient']
+
     def monkeypatch_bq(bq_client, *args, **kwargs):
-        from kaggle_gcp import get_integrations, PublicBigqueryClient, KaggleKernelCredentials
         specified_credentials = kwargs.get('credentials')
         has_bigquery = get_integrations().has_bigquery()
         # Prioritize passed in project id, but if it is missing look for env var. 
-        arg_project = kwargs.get('project')
-        explicit_project_id = arg_project or os.environ.get(environment_vars.PROJECT)
+        explicit_project_id = kwargs.get('project') or os.environ.get(environment_vars.PROJECT)
+        if explicit_project_id is None and specified_credentials is None and not has_bigquery:
+            print("Using Kaggle's public dataset BigQuery integration.")
+            return PublicBigqueryClient(*args, **kwargs)
         # This is a hack to get around the bug in google-cloud library.
         # Remove these two lines once this is resolved:
         # https://github.com/googleapis/google-cloud-python/issues/8108
         if explicit_project_id:
-            Log.info(f"Explicit project set to {explicit_project_id}")
+            Log.info("Explicit project set to %s", explicit_project_id)
             kwargs['project'] = explicit_project_id
-        if explicit_project_id is None and specified_credentials is None and not has_bigquery:
-            msg = "Using Kaggle's public dataset BigQuery integration."
-            Log.info(msg)
-            print(msg)
-            return PublicBigqueryClient(*args, **kwargs)
-        else:
-            if specified_credentials is None:
-                Log.info("No credentials specified, using KaggleKernelCredentials.")
-                kwargs['credentials'] = KaggleKernelCredentials()
-                if (not has_bigquery):
-                    Log.info("No bigquery integration found, creating client anyways.")
-                    print('Please ensure you have selected a BigQuery '
-                        'account in the Kernels Settings sidebar.')
-            if explicit_project_id is None:
-                Log.info("No project specified while using the unmodified client.")
-                print('Please ensure you specify a project id when creating the client'
-                    ' in order to use your BigQuery account.')
-            return bq_client(*args, **kwargs)
+        if specified_credentials is None:
+            Log.info("No credentials specified, using KaggleKernelCredentials.")
+            kwargs['credentials'] = KaggleKernelCredentials()
+            if (not has_bigquery):
+                Log.info("No bigquery integration found, creating client anyways.")
+                print('Please ensure you have selected a BigQuery '
+                    'account in the Kernels Settings sidebar.')
+        if explicit_project_id is None:
+            Log.info("No project specified while using the unmodified client.")
+            print('Please ensure you specify a project id when creating the client'
+                ' in order to use your BigQuery account.')
+        return bq_client(*args, **kwargs)
 
     # Monkey patches BigQuery client creation to use proxy or user-connected GCP account.
     # Deprecated in favor of Kaggle.DataProxyClient().
     # TODO: Remove this once uses have migrated to that new interface.
     bq_client = bigquery.Client
     if (not has_been_monkeypatched(bigquery.Client)):
-        bigquery.Client = lambda *args, **kwargs:  monkeypatch_bq(
-            bq_client, *args, **kwargs)
+        bigquery.Client = partial(monkeypatch_bq, bq_client)
+        bigquery.Client._kaggle_patched = True
     return bigquery
 
 def init_gcs():
-    is_user_secrets_token_set = "KAGGLE_USER_SECRETS_TOKEN" in os.environ
+    _refresh_env()
+    is_user_secrets_token_set = _ENV['user_secrets_token'] is not None
     from google.cloud import storage
     if not is_user_secrets_token_set:
         return storage
 
-    from kaggle_gcp import get_integrations
     if not get_integrations().has_gcs():
         return storage
 
-    from kaggle_secrets import GcpTarget
-    from kaggle_gcp import KaggleKernelCredentials
     gcs_client_init = storage.Client.__init__
     def monkeypatch_gcs(self, *args, **kwargs):
         specified_credentials = kwargs.get('credentials')
@@ -197,12 +470,30 @@ def init_gcs():
         return gcs_client_init(self, *args, **kwargs)
 
     if (not has_been_monkeypatched(storage.Client.__init__)):
+        monkeypatch_gcs._kaggle_patched = True
         storage.Client.__init__ = monkeypatch_gcs
     return storage
 
+def _import_hook_installed():
+    sitecustomize = sys.modules.get('sitecustomize')
+    finder_cls = getattr(sitecustomize, 'GcpModuleFinder', None)
+    return finder_cls is not None and any(isinstance(finder, finder_cls) for finder in sys.meta_path)
+
 def init():
-    init_bigquery()
-    init_gcs()
+    _refresh_env()
+    if _import_hook_installed():
+        # Only patch the client libraries which are already loaded. The ones imported later get
+        # patched by the import hook in sitecustomize, which avoids paying their import cost in
+        # kernels which never use them.
+        bigquery = sys.modules.get('google.cloud.bigquery')
+        storage = sys.modules.get('google.cloud.storage')
+    else:
+        # Nothing would patch the libraries imported later on, load them right away.
+        from google.cloud import bigquery, storage
+    if bigquery is not None and not has_been_monkeypatched(bigquery.Client):
+        init_bigquery()
+    if storage is not None and not has_been_monkeypatched(storage.Client.__init__):
+        init_gcs()
 
 # We need to initialize the monkeypatching of the client libraries
 # here since there is a circular dependency between our import hook version
@@ -1,6 +1,7 @@
 import unittest
 import os
 import json
+import tempfile
 from unittest.mock import patch
 import threading
 from test.support import EnvironmentVarGuard
@@ -11,13 +12,22 @@ from http.server import BaseHTTPRequestHandler, HTTPServer
 from google.cloud import bigquery
 from google.auth.exceptions import DefaultCredentialsError
 from google.cloud.bigquery._http import Connection
-from kaggle_gcp import KaggleKernelCredentials, PublicBigqueryClient, _DataProxyConnection, init_bigquery
+from kaggle_gcp import KaggleKernelCredentials, PublicBigqueryClient, _DataProxyConnection, get_integrations, init_bigquery
 import kaggle_secrets
+from kaggle_secrets import GcpTarget
 
 
 class TestBigQuery(unittest.TestCase):
 
     API_BASE_URL = "http://127.0.0.1:2121"
+
+    def setUp(self):
+        token_cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(token_cache_dir.cleanup)
+        token_cache_patch = patch.object(KaggleKernelCredentials, '_TOKEN_CACHE_DIR', token_cache_dir.name)
+        token_cache_patch.start()
+        self.addCleanup(token_cache_patch.stop)
+
     def _test_integration(self, client):
         class HTTPHandler(BaseHTTPRequestHandler):
             called = False
@@ -60,7 +70,7 @@ class TestBigQuery(unittest.TestCase):
         api_url_mock.__str__.return_value = self.API_BASE_URL
 
     @patch.object(Connection, 'API_BASE_URL')
-    @patch.object(kaggle_secrets.UserSecretsClient, 'get_bigquery_access_token', return_value=('secret',1000))
+    @patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token', return_value=('secret',1000))
     def test_project_with_connected_account(self, mock_access_token, ApiUrlMock):
         self._setup_mocks(ApiUrlMock)
         env = EnvironmentVarGuard()
@@ -71,7 +81,7 @@ class TestBigQuery(unittest.TestCase):
             self._test_integration(client)
 
     @patch.object(Connection, 'API_BASE_URL')
-    @patch.object(kaggle_secrets.UserSecretsClient, 'get_bigquery_access_token', return_value=('secret',1000))
+    @patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token', return_value=('secret',1000))
     def test_project_with_empty_integrations(self, mock_access_token, ApiUrlMock):
         self._setup_mocks(ApiUrlMock)
         env = EnvironmentVarGuard()
@@ -83,7 +93,7 @@ class TestBigQuery(unittest.TestCase):
             self._test_integration(client)
 
     @patch.object(Connection, 'API_BASE_URL')
-    @patch.object(kaggle_secrets.UserSecretsClient, 'get_bigquery_access_token', return_value=('secret',1000))
+    @patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token', return_value=('secret',1000))
     def test_project_with_connected_account_unrelated_integrations(self, mock_access_token, ApiUrlMock):
         self._setup_mocks(ApiUrlMock)
         env = EnvironmentVarGuard()
@@ -95,7 +105,7 @@ class TestBigQuery(unittest.TestCase):
             self._test_integration(client)
 
     @patch.object(Connection, 'API_BASE_URL')
-    @patch.object(kaggle_secrets.UserSecretsClient, 'get_bigquery_access_token', return_value=('secret',1000))
+    @patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token', return_value=('secret',1000))
     def test_project_with_connected_account_default_credentials(self, mock_access_token, ApiUrlMock):
         self._setup_mocks(ApiUrlMock)
         env = EnvironmentVarGuard()
@@ -106,7 +116,7 @@ class TestBigQuery(unittest.TestCase):
             self._test_integration(client)
 
     @patch.object(Connection, 'API_BASE_URL')
-    @patch.object(kaggle_secrets.UserSecretsClient, 'get_bigquery_access_token', return_value=('secret',1000))
+    @patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token', return_value=('secret',1000))
     def test_project_with_env_var_project_default_credentials(self, mock_access_token, ApiUrlMock):
         self._setup_mocks(ApiUrlMock)
         env = EnvironmentVarGuard()
@@ -118,7 +128,7 @@ class TestBigQuery(unittest.TestCase):
             self._test_integration(client)
 
     @patch.object(Connection, 'API_BASE_URL')
-    @patch.object(kaggle_secrets.UserSecretsClient, 'get_bigquery_access_token', return_value=('secret',1000))
+    @patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token', return_value=('secret',1000))
     def test_simultaneous_clients(self, mock_access_token, ApiUrlMock):
         self._setup_mocks(ApiUrlMock)
         env = EnvironmentVarGuard()
@@ -161,3 +171,20 @@ class TestBigQuery(unittest.TestCase):
             init_bigquery()
             from google.cloud.bigquery import magics
             self.assertIsNone(magics.context._credentials)
+
+    def test_get_integrations_follows_env(self):
+        env = EnvironmentVarGuard()
+        env.set('KAGGLE_KERNEL_INTEGRATIONS', 'BIGQUERY')
+        with env:
+            self.assertTrue(get_integrations().has_bigquery())
+            self.assertFalse(get_integrations().has_gcs())
+            env.set('KAGGLE_KERNEL_INTEGRATIONS', 'GCS')
+            self.assertFalse(get_integrations().has_bigquery())
+            self.assertTrue(get_integrations().has_gcs())
+
+    def test_get_integrations_not_shared_between_callers(self):
+        env = EnvironmentVarGuard()
+        env.set('KAGGLE_KERNEL_INTEGRATIONS', 'BIGQUERY')
+        with env:
+            get_integrations().add_integration(GcpTarget.GCS)
+            self.assertFalse(get_integrations().has_gcs())
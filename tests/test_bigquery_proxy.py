@@ -1,20 +1,28 @@
 import unittest
 import os
 import json
+import subprocess
+import sys
 from unittest.mock import patch
 import threading
 from test.support import EnvironmentVarGuard
 from urllib.parse import urlparse
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 from google.cloud import bigquery
 from google.auth.exceptions import DefaultCredentialsError
 from google.cloud.bigquery._http import Connection
+import kaggle_gcp
 from kaggle_gcp import KaggleKernelCredentials, PublicBigqueryClient, init_bigquery
 import kaggle_secrets
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
 class TestBigQuery(unittest.TestCase):
 
     def _test_proxy(self, client):
@@ -61,6 +69,47 @@ class TestBigQuery(unittest.TestCase):
             client = PublicBigqueryClient()
             self._test_proxy(client)
 
+    def test_proxy_clients_reuse_connections(self):
+        class HTTPHandler(BaseHTTPRequestHandler):
+            # Keep-alive is needed for connections to be reused.
+            protocol_version = "HTTP/1.1"
+            client_ports = []
+            proxy_headers_found = []
+
+            def do_GET(self):
+                HTTPHandler.client_ports.append(self.client_address[1])
+                HTTPHandler.proxy_headers_found.append(self.headers.get("X-KAGGLE-PROXY-DATA") == "test-key")
+                body = json.dumps({"kind": "bigquery#datasetList", "datasets": []}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if len(HTTPHandler.client_ports) == 2:
+                    # Don't leave a connection to this server in the shared pool for the other tests.
+                    self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        env = EnvironmentVarGuard()
+        env.unset('KAGGLE_USER_SECRETS_TOKEN')
+        with env:
+            server_address = urlparse(os.getenv('KAGGLE_DATA_PROXY_URL'))
+            with ThreadingHTTPServer((server_address.hostname, server_address.port), HTTPHandler) as httpd:
+                threading.Thread(target=httpd.serve_forever).start()
+                client1 = PublicBigqueryClient()
+                client2 = PublicBigqueryClient()
+                list(client1.list_datasets())
+                # Closing one client must not affect the pool shared with the others.
+                client1._http.close()
+                list(client2.list_datasets())
+                httpd.shutdown()
+
+        self.assertEqual([True, True], HTTPHandler.proxy_headers_found)
+        self.assertEqual(1, len(set(HTTPHandler.client_ports)),
+                         msg="Both clients should have reused the same pooled connection.")
+
     def test_proxy_no_project(self):
         env = EnvironmentVarGuard()
         env.unset('KAGGLE_USER_SECRETS_TOKEN')
@@ -77,6 +126,72 @@ class TestBigQuery(unittest.TestCase):
             client2 = bigquery.Client
             self.assertEqual(client1, client2)
 
+    def test_init_idempotent(self):
+        env = EnvironmentVarGuard()
+        env.unset('KAGGLE_USER_SECRETS_TOKEN')
+        with env:
+            client1 = bigquery.Client
+            kaggle_gcp.init()
+            kaggle_gcp.init()
+            client2 = bigquery.Client
+            self.assertTrue(kaggle_gcp.has_been_monkeypatched(client2))
+            self.assertEqual(client1, client2)
+
+    def _run_python(self, code, **env_overrides):
+        env = dict(os.environ)
+        env.pop('KAGGLE_USER_SECRETS_TOKEN', None)
+        env.update(env_overrides)
+        return subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE,
+                              universal_newlines=True, check=True).stdout.strip()
+
+    def test_import_does_not_load_bigquery(self):
+        output = self._run_python(
+            "import sys, kaggle_gcp; print('google.cloud.bigquery' in sys.modules)")
+        self.assertEqual('False', output)
+
+    def test_monkeypatching_after_public_client_resolved(self):
+        output = self._run_python(
+            "import kaggle_gcp; kaggle_gcp.PublicBigqueryClient\n"
+            "from google.cloud import bigquery\n"
+            "print(kaggle_gcp.has_been_monkeypatched(bigquery.Client))")
+        self.assertEqual('True', output)
+
+    def test_monkeypatching_without_import_hook(self):
+        output = self._run_python(
+            "import sys\n"
+            "sys.meta_path[:] = [f for f in sys.meta_path if type(f).__name__ != 'GcpModuleFinder']\n"
+            "import kaggle_gcp\n"
+            "from google.cloud import bigquery\n"
+            "print(kaggle_gcp.has_been_monkeypatched(bigquery.Client))")
+        self.assertEqual('True', output)
+
+    def test_public_client_lookup_does_not_reinit(self):
+        output = self._run_python(
+            "import sys\n"
+            "sys.meta_path[:] = [f for f in sys.meta_path if type(f).__name__ != 'GcpModuleFinder']\n"
+            "import kaggle_gcp\n"
+            "from google.cloud.bigquery import magics\n"
+            "credentials = magics.context.credentials = kaggle_gcp.KaggleKernelCredentials()\n"
+            "first, second = kaggle_gcp.PublicBigqueryClient, kaggle_gcp.PublicBigqueryClient\n"
+            "print(first is second, magics.context.credentials is credentials, "
+            "'PublicBigqueryClient' in vars(kaggle_gcp))",
+            KAGGLE_USER_SECRETS_TOKEN='foobar', KAGGLE_KERNEL_INTEGRATIONS='BIGQUERY')
+        self.assertEqual('True True True', output)
+
+    def test_init_idempotent_without_import_hook(self):
+        output = self._run_python(
+            "import sys\n"
+            "sys.meta_path[:] = [f for f in sys.meta_path if type(f).__name__ != 'GcpModuleFinder']\n"
+            "import kaggle_gcp\n"
+            "from google.cloud import bigquery\n"
+            "from google.cloud.bigquery import magics\n"
+            "client, credentials = bigquery.Client, magics.context.credentials\n"
+            "kaggle_gcp.init()\n"
+            "kaggle_gcp.init()\n"
+            "print(bigquery.Client is client, magics.context.credentials is credentials, credentials is not None)",
+            KAGGLE_USER_SECRETS_TOKEN='foobar', KAGGLE_KERNEL_INTEGRATIONS='BIGQUERY')
+        self.assertEqual('True True True', output)
+
     def test_proxy_with_kwargs(self):
         env = EnvironmentVarGuard()
         env.unset('KAGGLE_USER_SECRETS_TOKEN')
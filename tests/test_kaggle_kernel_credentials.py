@@ -1,10 +1,151 @@
+import io
+import os
+import tempfile
+import threading
+import time
 import unittest
 
+from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+from test.support import EnvironmentVarGuard
+from unittest.mock import patch
+
+from google.auth.exceptions import RefreshError
+
+import kaggle_secrets
 from kaggle_secrets import GcpTarget
 from kaggle_gcp import KaggleKernelCredentials
 
 class TestKaggleKernelCredentials(unittest.TestCase):
 
+    def setUp(self):
+        token_cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(token_cache_dir.cleanup)
+        self.token_cache_dir = token_cache_dir.name
+        token_cache_patch = patch.object(KaggleKernelCredentials, '_TOKEN_CACHE_DIR', token_cache_dir.name)
+        token_cache_patch.start()
+        self.addCleanup(token_cache_patch.stop)
+
     def test_default_target(self):
         creds = KaggleKernelCredentials()
         self.assertEqual(GcpTarget.BIGQUERY, creds.target)
+
+    def test_concurrent_refresh_fetches_token_once(self):
+        def slow_access_token(target):
+            time.sleep(0.1)
+            return 'secret', datetime.utcnow() + timedelta(hours=1)
+        env = EnvironmentVarGuard()
+        env.set('KAGGLE_USER_SECRETS_TOKEN', 'foobar')
+        with env, patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token',
+                               side_effect=slow_access_token) as mock_access_token:
+            creds = KaggleKernelCredentials()
+            threads = [threading.Thread(target=creds.refresh, args=(None,)) for _ in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual('secret', creds.token)
+            self.assertEqual(1, mock_access_token.call_count)
+
+    def test_token_near_expiry_refreshed_in_background(self):
+        def slow_access_token(target):
+            time.sleep(0.1)
+            return 'new_secret', datetime.utcnow() + timedelta(hours=1)
+        env = EnvironmentVarGuard()
+        env.set('KAGGLE_USER_SECRETS_TOKEN', 'foobar')
+        with env, patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token',
+                               side_effect=slow_access_token):
+            creds = KaggleKernelCredentials()
+            creds.token = 'old_secret'
+            creds.expiry = datetime.utcnow() + timedelta(minutes=8)
+            headers = {}
+            creds.before_request(None, 'GET', 'https://www.googleapis.com', headers)
+            self.assertEqual('Bearer old_secret', headers['authorization'])
+            for _ in range(100):
+                if creds.token == 'new_secret':
+                    break
+                time.sleep(0.01)
+            self.assertEqual('new_secret', creds.token)
+
+    def test_refreshed_token_reused_by_new_credentials(self):
+        def access_token_for_jwt(client, target):
+            return 'secret-' + client.jwt_token, datetime.utcnow() + timedelta(hours=1)
+        env = EnvironmentVarGuard()
+        env.set('KAGGLE_USER_SECRETS_TOKEN', 'foobar')
+        with env, patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token', autospec=True,
+                               side_effect=access_token_for_jwt) as mock_access_token:
+            KaggleKernelCredentials().refresh(None)
+            creds = KaggleKernelCredentials()
+            creds.before_request(None, 'GET', 'https://www.googleapis.com', {})
+            self.assertEqual('secret-foobar', creds.token)
+            self.assertEqual(1, mock_access_token.call_count)
+            # Tokens cached for another session are ignored, and fetched with that session's token.
+            env.set('KAGGLE_USER_SECRETS_TOKEN', 'another')
+            creds = KaggleKernelCredentials()
+            creds.before_request(None, 'GET', 'https://www.googleapis.com', {})
+            self.assertEqual('secret-another', creds.token)
+            self.assertEqual(2, mock_access_token.call_count)
+            creds = KaggleKernelCredentials()
+            creds.before_request(None, 'GET', 'https://www.googleapis.com', {})
+            self.assertEqual('secret-another', creds.token)
+            self.assertEqual(2, mock_access_token.call_count)
+
+    def test_refresh_replaces_token_without_expiry(self):
+        env = EnvironmentVarGuard()
+        env.set('KAGGLE_USER_SECRETS_TOKEN', 'foobar')
+        with env, patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token',
+                               return_value=('new_secret', None)) as mock_access_token:
+            creds = KaggleKernelCredentials()
+            creds.token = 'revoked'
+            creds.expiry = None
+            creds.refresh(None)
+            self.assertEqual('new_secret', creds.token)
+            self.assertEqual(1, mock_access_token.call_count)
+
+    def test_failed_background_refresh_not_retried(self):
+        env = EnvironmentVarGuard()
+        env.set('KAGGLE_USER_SECRETS_TOKEN', 'foobar')
+        env.unset('KAGGLE_KERNEL_INTEGRATIONS')
+        stdout = io.StringIO()
+        with env, redirect_stdout(stdout), patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token',
+                                                        side_effect=ConnectionError()) as mock_access_token:
+            creds = KaggleKernelCredentials()
+            creds.token = 'old_secret'
+            creds.expiry = datetime.utcnow() + timedelta(minutes=8)
+            for _ in range(5):
+                creds.before_request(None, 'GET', 'https://www.googleapis.com', {})
+                for _ in range(100):
+                    if not creds._async_refresh_in_flight:
+                        break
+                    time.sleep(0.01)
+            self.assertEqual(1, mock_access_token.call_count)
+            self.assertEqual('old_secret', creds.token)
+        self.assertEqual('', stdout.getvalue())
+
+    def test_refresh_discards_replaced_cached_token(self):
+        env = EnvironmentVarGuard()
+        env.set('KAGGLE_USER_SECRETS_TOKEN', 'foobar')
+        expiry = datetime.utcnow() + timedelta(hours=1)
+        with env, patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token',
+                               return_value=('revoked', expiry)) as mock_access_token:
+            creds = KaggleKernelCredentials()
+            creds.refresh(None)
+            mock_access_token.side_effect = ConnectionError()
+            with redirect_stdout(io.StringIO()), self.assertRaises(RefreshError):
+                creds.refresh(None)
+            # The revoked token isn't handed out from the cache anymore.
+            with redirect_stdout(io.StringIO()), self.assertRaises(RefreshError):
+                KaggleKernelCredentials().before_request(None, 'GET', 'https://www.googleapis.com', {})
+            self.assertEqual(3, mock_access_token.call_count)
+
+    def test_failed_token_caching_leaves_no_token_behind(self):
+        env = EnvironmentVarGuard()
+        env.set('KAGGLE_USER_SECRETS_TOKEN', 'foobar')
+        expiry = datetime.utcnow() + timedelta(hours=1)
+        with env, patch.object(kaggle_secrets.UserSecretsClient, '_get_access_token',
+                               return_value=('secret', expiry)), \
+                patch('kaggle_gcp.json.dump', side_effect=TypeError()):
+            creds = KaggleKernelCredentials()
+            creds.refresh(None)
+            self.assertEqual('secret', creds.token)
+        self.assertEqual([], [f for f in os.listdir(self.token_cache_dir) if not f.endswith('.lock')])